@@ -1,34 +1,167 @@
-from flask import Flask, request, jsonify
+from quart import Quart, Response, request, jsonify
+from quart.json.provider import DefaultJSONProvider
+import httpx
 import openai
+import requests
 import stripe
-import json
+from requests.adapters import HTTPAdapter
+import asyncio
+import atexit
+import logging
+import logging.handlers
+import queue
+import orjson
 import os
-from typing import List, Dict
+import sys
+import hashlib
+import random
+import re
+import types
+import uuid
+from array import array
+from typing import List, Dict, Optional, Tuple
+import redis
+import redis.asyncio
+from redis.commands.search.field import TagField, TextField, VectorField
+from redis.commands.search.indexDefinition import IndexDefinition, IndexType
+from redis.commands.search.query import Query
+from cachetools import LRUCache, TTLCache
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_exponential_jitter
 from dotenv import load_dotenv
+from pythonjsonlogger import jsonlogger
+from openai.types.chat import ChatCompletion, ChatCompletionMessage
 
 # Load environment variables from .env file
 load_dotenv()
 
-app = Flask(__name__)
+# Structured JSON logs; records are queued and written by a background thread so request
+# handlers never block on stdout. Set LOG_LEVEL=WARNING in production to skip per-request lines.
+_log_queue = queue.SimpleQueue()
+_log_stream_handler = logging.StreamHandler()
+_log_stream_handler.setFormatter(jsonlogger.JsonFormatter("%(asctime)s %(levelname)s %(name)s %(message)s"))
+_log_listener = logging.handlers.QueueListener(_log_queue, _log_stream_handler)
+_log_listener.start()
+_log_listener_stopped = False
+
+def _stop_log_listener():
+    """Flush queued records and stop the writer thread (safe to call more than once)"""
+    global _log_listener_stopped
+    if not _log_listener_stopped:
+        _log_listener_stopped = True
+        _log_listener.stop()
+
+# Also runs on sys.exit() during import, so startup errors are not lost
+atexit.register(_stop_log_listener)
+
+logger = logging.getLogger("app")
+logger.addHandler(logging.handlers.QueueHandler(_log_queue))
+logger.setLevel(os.getenv('LOG_LEVEL', 'INFO').upper())
+logger.propagate = False
+
+class ORJSONProvider(DefaultJSONProvider):
+    """Serialize request/response bodies with orjson"""
+    def dumps(self, obj, **kwargs) -> str:
+        return orjson.dumps(obj).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+app = Quart(__name__)
+app.json = ORJSONProvider(app)
 
 # Add CORS headers manually
 @app.after_request
-def after_request(response):
+async def after_request(response):
     response.headers.add('Access-Control-Allow-Origin', '*')
     response.headers.add('Access-Control-Allow-Headers', 'Content-Type')
     response.headers.add('Access-Control-Allow-Methods', 'GET,POST,OPTIONS')
+    response.headers.add('Access-Control-Expose-Headers', 'X-Cache')
     return response
 
-# Configuration - Initialize OpenAI client
-client = openai.OpenAI(api_key=os.getenv('OPENAI_API_KEY'))
-stripe.api_key = os.getenv('STRIPE_SECRET_KEY')
+# Configuration - read once at import; a missing key raises KeyError so every worker fails fast
+OPENAI_KEY = os.environ["OPENAI_API_KEY"]
+STRIPE_KEY = os.environ["STRIPE_SECRET_KEY"]
+STRIPE_KEY_PREFIX = STRIPE_KEY[:12]
 STRIPE_WEBHOOK_SECRET = os.getenv('STRIPE_WEBHOOK_SECRET')
 
-# In-memory conversation history (use database in production)
-conversations = {}
+# Shared keep-alive connection pools, so OpenAI/Stripe calls reuse TCP+TLS sessions
+# (HTTP/2 lets concurrent OpenAI calls multiplex over one connection)
+http_client = httpx.AsyncClient(
+    http2=True,
+    limits=httpx.Limits(max_keepalive_connections=50, max_connections=200),
+    timeout=httpx.Timeout(30.0, connect=5.0)
+)
+_stripe_session = requests.Session()
+_stripe_session.mount('https://', HTTPAdapter(pool_connections=50, pool_maxsize=200))
+
+# Initialize OpenAI client (async, so one worker can multiplex many in-flight calls)
+# (SDK-level retries are disabled; transient failures are retried by _openai_call below)
+client = openai.AsyncOpenAI(api_key=OPENAI_KEY, http_client=http_client, max_retries=0)
+stripe.api_key = STRIPE_KEY
+stripe.default_http_client = stripe.http_client.RequestsClient(session=_stripe_session)
+
+# Whole-key match, so stray whitespace or truncation from a mis-edited .env is rejected too
+_STRIPE_KEY_RE = re.compile(r'sk_(test|live)_[A-Za-z0-9]{24,}')
+
+def _validate_keys():
+    """Validate the Stripe key format at import so production server workers fail fast too"""
+    logger.info("OpenAI and Stripe API keys loaded, Stripe key starts with %s...", STRIPE_KEY_PREFIX)
+    
+    match = _STRIPE_KEY_RE.fullmatch(STRIPE_KEY)
+    if not match:
+        logger.error("Invalid Stripe API key format")
+        sys.exit(1)
+    
+    # Check if in test mode
+    if match.group(1) == 'test':
+        logger.info("Stripe is in TEST MODE (safe for development)")
+    else:
+        logger.warning("Stripe is in LIVE MODE (real charges will be made!)")
+
+_validate_keys()
+
+# Optional Redis (Stack, for RediSearch) instance backing conversation state and the semantic cache
+REDIS_URL = os.getenv('REDIS_URL')
+redis_client = redis.asyncio.Redis(
+    connection_pool=redis.asyncio.BlockingConnectionPool.from_url(REDIS_URL, max_connections=64)
+) if REDIS_URL else None
+
+# Chain turns with the Responses API (previous_response_id) instead of resending history
+USE_RESPONSES_API = os.getenv('USE_RESPONSES_API', '').lower() in ('1', 'true', 'yes')
+
+SYSTEM_PROMPT = """You are a helpful sales assistant for a gift card store. 
+                
+Help users browse and purchase gift cards. When they want to buy something:
+1. Use the create_checkout_session function to generate a payment link
+2. The function will return a JSON with "checkout_url"
+3. Share that URL with the user in a friendly way
+
+Important: When you receive the checkout URL, present it to the user like this:
+"Great! I've created your checkout session. Click here to complete your payment: [URL]"
+
+Always be friendly and helpful!"""
+# One shared system message for every session (message dicts are never mutated after creation)
+_SYSTEM_MSG = {"role": "system", "content": SYSTEM_PROMPT}
+
+# Conversation state: kept in Redis when configured (shared across workers, survives restarts),
+# otherwise in memory for single-process development
+CONVERSATION_TTL = 24 * 60 * 60  # 1 day
+# In-memory sessions are evicted after an hour without a new turn
+conversations = TTLCache(maxsize=10000, ttl=3600)
+previous_response_ids = TTLCache(maxsize=10000, ttl=3600)
 
-# Sample product catalog
-PRODUCTS = {
+# Once a history exceeds HISTORY_MAX_MESSAGES, everything but the last HISTORY_KEEP_RECENT
+# messages is folded into one summary, so per-turn tokens stay bounded
+HISTORY_MAX_MESSAGES = 20
+HISTORY_KEEP_RECENT = 10
+SUMMARY_PROMPT = "Summarize the conversation so far in <=200 tokens"
+COMPACTION_LOCK_TTL = 60  # seconds
+COMPACTION_TRIM_ATTEMPTS = 3
+# In-memory sessions being compacted (Redis sessions use a shared compact:<session_id> lock instead)
+_compacting = set()
+
+# Sample product catalog (read-only: derived payloads below are precomputed from it)
+PRODUCTS = types.MappingProxyType({
     "gift_card_25": {
         "name": "$25 Gift Card",
         "price": 2500,  # in cents
@@ -47,6 +180,33 @@ PRODUCTS = {
         "currency": "usd",
         "description": "Premium gift option"
     }
+})
+
+# Precomputed list_products() payload
+_PRODUCTS_JSON = orjson.dumps([
+    {
+        "id": pid,
+        "name": product["name"],
+        "price": f"${product['price']/100:.2f}",
+        "description": product["description"]
+    }
+    for pid, product in PRODUCTS.items()
+]).decode()
+
+# Precomputed Stripe Checkout line items per product
+_PRODUCT_LINE_ITEMS = {
+    pid: [{
+        'price_data': {
+            'currency': product['currency'],
+            'product_data': {
+                'name': product['name'],
+                'description': product['description'],
+            },
+            'unit_amount': product['price'],
+        },
+        'quantity': 1,
+    }]
+    for pid, product in PRODUCTS.items()
 }
 
 # Define available functions for ChatGPT
@@ -99,43 +259,336 @@ tools = [
     }
 ]
 
+def _is_transient(e: BaseException) -> bool:
+    """True for failures worth retrying: connection errors/timeouts, 429s and 5xx responses"""
+    if isinstance(e, (openai.APIConnectionError, stripe.error.APIConnectionError)):
+        return True
+    if isinstance(e, openai.APIStatusError):
+        return e.status_code == 429 or e.status_code >= 500
+    if isinstance(e, stripe.error.StripeError):
+        return e.http_status is not None and (e.http_status == 429 or e.http_status >= 500)
+    return False
+
+# Capped exponential backoff with jitter, so retrying clients don't synchronize into storms
+_retry_transient = retry(
+    retry=retry_if_exception(_is_transient),
+    wait=wait_exponential_jitter(initial=0.2, max=5.0),
+    stop=stop_after_attempt(4),
+    reraise=True
+)
+
+@_retry_transient
+async def _openai_call(create, **kwargs):
+    """Call an OpenAI client method, retrying transient failures"""
+    return await create(**kwargs)
+
+@_retry_transient
+def _stripe_call(create, **kwargs):
+    """Call a blocking Stripe create method, retrying transient failures (run via asyncio.to_thread)"""
+    return create(**kwargs)
+
+def _idempotency_key(operation: str, call_id: str) -> str:
+    """Key unique to one model-issued tool call, so retries of that call never double-charge"""
+    return f"{operation}-{call_id}"
+
+# Post-tool summarization is latency-tolerant, so it runs on the cheaper Flex processing tier
+SUMMARY_SERVICE_TIER = os.getenv('OPENAI_SUMMARY_SERVICE_TIER', 'flex')
+FLEX_MAX_ATTEMPTS = 2
+FLEX_BACKOFF_BASE = 0.5  # seconds
+# Per-attempt timeout for Flex (the shared client allows 30s). A timed-out attempt falls back to the
+# default tier at once, so a slow Flex queue adds at most ~FLEX_TIMEOUT; the worst case (both attempts
+# failing slowly with 429/5xx) adds FLEX_MAX_ATTEMPTS * FLEX_TIMEOUT + FLEX_BACKOFF_BASE, ~10.5s.
+FLEX_TIMEOUT = float(os.getenv('OPENAI_FLEX_TIMEOUT', '5'))
+# Cleared once OpenAI rejects the tier for our model, so we stop paying for the failed attempt
+_flex_supported = True
+
+async def create_summary_completion(**kwargs):
+    """Create a completion on the Flex tier, falling back to the default tier when Flex is unavailable"""
+    global _flex_supported
+    if _flex_supported:
+        for attempt in range(FLEX_MAX_ATTEMPTS):
+            try:
+                return await client.chat.completions.create(
+                    service_tier=SUMMARY_SERVICE_TIER, timeout=FLEX_TIMEOUT, **kwargs
+                )
+            except openai.BadRequestError as e:
+                if e.param != "service_tier":
+                    raise
+                logger.warning("Service tier %s unsupported, using default: %s", SUMMARY_SERVICE_TIER, e)
+                _flex_supported = False
+                break
+            except openai.APITimeoutError as e:
+                # Flex queue too slow for an interactive turn; don't wait for it again
+                logger.warning(
+                    "Service tier %s timed out after %ss, using default: %s", SUMMARY_SERVICE_TIER, FLEX_TIMEOUT, e
+                )
+                break
+            except (openai.APIConnectionError, openai.APIStatusError) as e:
+                # Flex queue full, capacity unavailable, or a 5xx; back off with full jitter,
+                # then fall back to the default tier (which retries transient failures itself)
+                if not _is_transient(e):
+                    raise
+                if attempt + 1 < FLEX_MAX_ATTEMPTS:
+                    await asyncio.sleep(random.uniform(0, FLEX_BACKOFF_BASE * 2 ** attempt))
+    return await _openai_call(client.chat.completions.create, service_tier="default", **kwargs)
+
+# Exact-match cache of chat completions (keyed by model + tool schema + messages)
+_completion_cache = LRUCache(maxsize=1024)
+_TOOLS_HASH = hashlib.sha256(orjson.dumps(tools, option=orjson.OPT_SORT_KEYS)).hexdigest()
+
+def _completion_cache_key(model: str, messages: List[Dict], tools_hash: Optional[str]) -> str:
+    """Hash the request, ignoring per-call tool_call ids so equivalent turns collide"""
+    normalized = []
+    for message in messages:
+        message = {k: v for k, v in message.items() if k != "tool_call_id"}
+        if message.get("tool_calls"):
+            message["tool_calls"] = [
+                [tc["function"]["name"], tc["function"]["arguments"]] for tc in message["tool_calls"]
+            ]
+        normalized.append(message)
+    return hashlib.sha256(
+        orjson.dumps([model, tools_hash, normalized], option=orjson.OPT_SORT_KEYS, default=str)
+    ).hexdigest()
+
+async def cached_completion(
+    messages: List[Dict], tools: Optional[List[Dict]] = None, flex: bool = True
+) -> Tuple[ChatCompletion, bool]:
+    """Return (completion, cache_hit), calling OpenAI only on a miss (summaries use Flex unless flex=False)"""
+    model = "gpt-4o-mini"
+    key = _completion_cache_key(model, messages, _TOOLS_HASH if tools else None)
+    
+    cached = _completion_cache.get(key)
+    if cached is not None:
+        return ChatCompletion.model_validate(cached), True
+    
+    if tools:
+        response = await _openai_call(
+            client.chat.completions.create,
+            model=model, messages=messages, tools=tools, tool_choice="auto"
+        )
+    elif flex:
+        response = await create_summary_completion(model=model, messages=messages)
+    else:
+        response = await _openai_call(client.chat.completions.create, model=model, messages=messages)
+    
+    # Tool-calling turns are never cached: replaying them would skip (or repeat) side effects
+    if not response.choices[0].message.tool_calls:
+        _completion_cache[key] = response.model_dump()
+    return response, False
+
+# Semantic cache: reuse prior replies to rephrased questions (cosine similarity on embeddings)
+SEMANTIC_CACHE_INDEX = "idx:semantic_cache"
+SEMANTIC_CACHE_THRESHOLD = 0.92
+SEMANTIC_CACHE_TTL = 4 * 60 * 60  # 4 hours
+EMBEDDING_MODEL = "text-embedding-3-small"
+EMBEDDING_DIM = 1536
+# Replies are only reused within side-effect-free intents ("buy" turns are never cached)
+_CACHEABLE_INTENTS = ("chat", "list_products")
+_SIDE_EFFECT_TOOLS = {"create_checkout_session", "process_test_payment"}
+_SEMANTIC_QUERY = (
+    Query(f"(@intent:{{{'|'.join(_CACHEABLE_INTENTS)}}})=>[KNN 1 @embedding $vec AS score]")
+    .return_fields("response", "score")
+    .dialect(2)
+)
+
+async def _ensure_semantic_index():
+    """Create the HNSW vector index if it does not exist yet"""
+    index = redis_client.ft(SEMANTIC_CACHE_INDEX)
+    try:
+        await index.info()
+    except redis.ResponseError:
+        await index.create_index(
+            [
+                TagField("intent"),
+                TextField("response"),
+                VectorField("embedding", "HNSW", {
+                    "TYPE": "FLOAT32",
+                    "DIM": EMBEDDING_DIM,
+                    "DISTANCE_METRIC": "COSINE"
+                }),
+            ],
+            definition=IndexDefinition(prefix=["cache:"], index_type=IndexType.HASH)
+        )
+
+async def semantic_cache_lookup(user_message: str) -> Tuple[Optional[bytes], Optional[str]]:
+    """Return (embedding, cached_reply); cached_reply is None on a miss"""
+    try:
+        result = await client.embeddings.create(model=EMBEDDING_MODEL, input=user_message)
+        embedding = array('f', result.data[0].embedding).tobytes()
+        docs = (await redis_client.ft(SEMANTIC_CACHE_INDEX).search(
+            _SEMANTIC_QUERY, query_params={"vec": embedding}
+        )).docs
+    except (redis.RedisError, openai.OpenAIError) as e:
+        logger.warning("Semantic cache lookup failed: %s", e)
+        return None, None
+    
+    # RediSearch reports cosine *distance*; similarity = 1 - distance
+    if docs and 1 - float(docs[0].score) >= SEMANTIC_CACHE_THRESHOLD:
+        return embedding, docs[0].response
+    return embedding, None
+
+async def semantic_cache_store(embedding: bytes, intent: str, reply: str):
+    """Store a reply under its intent namespace with a TTL"""
+    key = f"cache:{intent}:{uuid.uuid4().hex}"
+    try:
+        pipe = redis_client.pipeline()
+        pipe.hset(key, mapping={"embedding": embedding, "intent": intent, "response": reply})
+        pipe.expire(key, SEMANTIC_CACHE_TTL)
+        await pipe.execute()
+    except redis.RedisError as e:
+        logger.warning("Semantic cache store failed: %s", e)
+
+@app.before_serving
+async def startup():
+    if redis_client is not None:
+        await _ensure_semantic_index()
+
+@app.after_serving
+async def shutdown():
+    await http_client.aclose()
+    _stripe_session.close()
+    if redis_client is not None:
+        await redis_client.aclose()
+    _stop_log_listener()
+
+async def load_history(session_id: str) -> List[Dict]:
+    """Return a working copy of the session's messages, starting with the system prompt"""
+    if redis_client is not None:
+        stored = await redis_client.lrange(f"conv:{session_id}", 0, -1)
+        return [_SYSTEM_MSG] + [orjson.loads(m) for m in stored]
+    
+    history = conversations.get(session_id)
+    if history is None:
+        history = conversations[session_id] = [_SYSTEM_MSG]
+    return list(history)
+
+async def append_history(session_id: str, messages: List[Dict]):
+    """Persist the messages produced by one turn, compacting the history when it gets long"""
+    if redis_client is not None:
+        key = f"conv:{session_id}"
+        pipe = redis_client.pipeline()
+        pipe.rpush(key, *[orjson.dumps(m) for m in messages])
+        pipe.expire(key, CONVERSATION_TTL)
+        stored_length, _ = await pipe.execute()
+        length = stored_length + 1  # plus the system prompt
+    else:
+        history = conversations.get(session_id) or [_SYSTEM_MSG]
+        history.extend(messages)
+        conversations[session_id] = history  # re-set to refresh the TTL
+        length = len(history)
+    
+    if length <= HISTORY_MAX_MESSAGES:
+        return
+    
+    # Only one compaction per session at a time, across all workers sharing the history
+    if redis_client is not None:
+        lock = redis_client.lock(f"compact:{session_id}", timeout=COMPACTION_LOCK_TTL)
+        if await lock.acquire(blocking=False):
+            app.add_background_task(compact_history, session_id, lock)
+    elif session_id not in _compacting:
+        _compacting.add(session_id)
+        app.add_background_task(compact_history, session_id)
+
+async def _replace_compacted_prefix(session_id: str, compacted: List[bytes], summary: Dict):
+    """Swap the compacted prefix for the summary, unless another writer changed it meanwhile"""
+    key = f"conv:{session_id}"
+    async with redis_client.pipeline(transaction=True) as pipe:
+        for _ in range(COMPACTION_TRIM_ATTEMPTS):
+            try:
+                await pipe.watch(key)
+                if await pipe.lrange(key, 0, len(compacted) - 1) != compacted:
+                    logger.info("History changed during compaction, skipping session_id=%s", session_id)
+                    return
+                pipe.multi()
+                pipe.ltrim(key, len(compacted), -1)
+                pipe.lpush(key, orjson.dumps(summary))
+                await pipe.execute()
+                return
+            except redis.WatchError:
+                # A turn was appended meanwhile; re-check the prefix and try again
+                continue
+        logger.warning("Gave up trimming compacted history session_id=%s", session_id)
+
+async def compact_history(session_id: str, lock=None):
+    """Replace all but the most recent messages with a short summary"""
+    try:
+        if redis_client is not None:
+            stored = await redis_client.lrange(f"conv:{session_id}", 0, -1)
+            history = [_SYSTEM_MSG] + [orjson.loads(m) for m in stored]
+        else:
+            history = await load_history(session_id)
+        # Start the kept tail on a non-tool message, so tool results stay with their tool call
+        cut = len(history) - HISTORY_KEEP_RECENT
+        while cut < len(history) and history[cut]["role"] == "tool":
+            cut += 1
+        
+        # Old tool payloads (catalog JSON, Stripe responses) rarely help later turns; summarize the dialogue
+        transcript = "\n".join(
+            f"{m['role']}: {m['content']}" for m in history[1:cut] if m["role"] != "tool" and m.get("content")
+        )
+        response = await _openai_call(
+            client.chat.completions.create,
+            model="gpt-4o-mini",
+            messages=[
+                {"role": "system", "content": SUMMARY_PROMPT},
+                {"role": "user", "content": transcript}
+            ],
+            max_tokens=200
+        )
+        summary = {
+            "role": "system",
+            "content": f"Summary of the earlier conversation: {response.choices[0].message.content}"
+        }
+        
+        # Drop only the compacted prefix; turns appended meanwhile are kept
+        if redis_client is not None:
+            await _replace_compacted_prefix(session_id, stored[:cut - 1], summary)
+        elif session_id in conversations:
+            conversations[session_id][1:cut] = [summary]
+    finally:
+        if lock is not None:
+            try:
+                await lock.release()
+            except redis.exceptions.LockError:
+                # Lock expired mid-compaction; the prefix check above still guards the trim
+                pass
+        else:
+            _compacting.discard(session_id)
+
+async def load_previous_response_id(session_id: str) -> Optional[str]:
+    """Return the last Responses API id for the session, if any"""
+    if redis_client is not None:
+        previous_id = await redis_client.get(f"prev:{session_id}")
+        return previous_id.decode() if previous_id else None
+    return previous_response_ids.get(session_id)
+
+async def save_previous_response_id(session_id: str, response_id: str):
+    """Remember the latest Responses API id so the next turn can chain from it"""
+    if redis_client is not None:
+        await redis_client.set(f"prev:{session_id}", response_id, ex=CONVERSATION_TTL)
+    else:
+        previous_response_ids[session_id] = response_id
+
 def list_products() -> str:
     """Return list of available products"""
-    products_info = []
-    for pid, product in PRODUCTS.items():
-        products_info.append({
-            "id": pid,
-            "name": product["name"],
-            "price": f"${product['price']/100:.2f}",
-            "description": product["description"]
-        })
-    return json.dumps(products_info)
+    return _PRODUCTS_JSON
 
-def create_checkout_session(product_id: str) -> str:
+async def create_checkout_session(product_id: str, call_id: str) -> str:
     """Create Stripe checkout session"""
     if product_id not in PRODUCTS:
-        return json.dumps({"error": "Product not found"})
-    
-    product = PRODUCTS[product_id]
+        return orjson.dumps({"error": "Product not found"}).decode()
     
     try:
-        print(f"Creating checkout session for product: {product_id}")
-        print(f"Using Stripe API Key: {stripe.api_key[:20]}...")
+        logger.info("Creating checkout session product_id=%s", product_id)
         
         # Create Stripe Checkout Session with proper configuration
-        session = stripe.checkout.Session.create(
+        # (Stripe's SDK is blocking, so run it off the event loop)
+        session = await asyncio.to_thread(
+            _stripe_call,
+            stripe.checkout.Session.create,
+            idempotency_key=_idempotency_key("checkout", call_id),
             payment_method_types=['card'],
-            line_items=[{
-                'price_data': {
-                    'currency': product['currency'],
-                    'product_data': {
-                        'name': product['name'],
-                        'description': product['description'],
-                    },
-                    'unit_amount': product['price'],
-                },
-                'quantity': 1,
-            }],
+            line_items=_PRODUCT_LINE_ITEMS[product_id],
             mode='payment',
             success_url='https://example.com/success?session_id={CHECKOUT_SESSION_ID}',
             cancel_url='https://example.com/cancel',
@@ -144,42 +597,44 @@ def create_checkout_session(product_id: str) -> str:
             },
         )
         
-        print(f"✅ Checkout session created successfully!")
-        print(f"✅ Session ID: {session.id}")
-        print(f"✅ Checkout URL: {session.url}")
-        print(f"✅ Payment status: {session.payment_status}")
+        logger.info(
+            "Checkout session created id=%s url=%s payment_status=%s",
+            session.id, session.url, session.payment_status
+        )
         
-        return json.dumps({
+        return orjson.dumps({
             "success": True,
             "checkout_url": session.url,
             "session_id": session.id
-        })
+        }).decode()
     except stripe.error.AuthenticationError as e:
         error_msg = "Authentication failed. Please check your Stripe API key."
-        print(f"❌ Authentication Error: {str(e)}")
-        return json.dumps({"error": error_msg})
+        logger.error("Stripe authentication error: %s", e)
+        return orjson.dumps({"error": error_msg}).decode()
     except stripe.error.StripeError as e:
         error_msg = str(e)
-        print(f"❌ Stripe Error: {error_msg}")
-        return json.dumps({"error": f"Stripe error: {error_msg}"})
+        logger.error("Stripe error: %s", error_msg)
+        return orjson.dumps({"error": f"Stripe error: {error_msg}"}).decode()
     except Exception as e:
-        print(f"❌ General Error: {str(e)}")
-        import traceback
-        traceback.print_exc()
-        return json.dumps({"error": str(e)})
+        logger.exception("Unexpected error creating checkout session")
+        return orjson.dumps({"error": str(e)}).decode()
 
-def process_test_payment(product_id: str) -> str:
+async def process_test_payment(product_id: str, call_id: str) -> str:
     """Process payment server-side with test card credentials"""
     if product_id not in PRODUCTS:
-        return json.dumps({"error": "Product not found"})
+        return orjson.dumps({"error": "Product not found"}).decode()
     
     product = PRODUCTS[product_id]
+    idempotency_key = _idempotency_key("payment", call_id)
     
     try:
-        print(f"🔄 Processing server-side payment for: {product['name']}")
+        logger.info("Processing server-side payment product=%s", product['name'])
         
         # Create a test payment method with test card
-        payment_method = stripe.PaymentMethod.create(
+        payment_method = await asyncio.to_thread(
+            _stripe_call,
+            stripe.PaymentMethod.create,
+            idempotency_key=f"{idempotency_key}-pm",
             type='card',
             card={
                 'number': '4242424242424242',  # Test card
@@ -189,10 +644,13 @@ def process_test_payment(product_id: str) -> str:
             },
         )
         
-        print(f"✅ Payment method created: {payment_method.id}")
+        logger.info("Payment method created id=%s", payment_method.id)
         
         # Create a payment intent
-        payment_intent = stripe.PaymentIntent.create(
+        payment_intent = await asyncio.to_thread(
+            _stripe_call,
+            stripe.PaymentIntent.create,
+            idempotency_key=f"{idempotency_key}-pi",
             amount=product['price'],
             currency=product['currency'],
             payment_method=payment_method.id,
@@ -208,175 +666,381 @@ def process_test_payment(product_id: str) -> str:
             }
         )
         
-        print(f"✅ Payment Intent created: {payment_intent.id}")
-        print(f"✅ Payment Status: {payment_intent.status}")
+        logger.info("Payment intent created id=%s status=%s", payment_intent.id, payment_intent.status)
         
         if payment_intent.status == 'succeeded':
-            return json.dumps({
+            return orjson.dumps({
                 "success": True,
                 "payment_id": payment_intent.id,
                 "amount": payment_intent.amount / 100,
                 "currency": payment_intent.currency.upper(),
                 "status": "succeeded",
                 "message": f"Payment successful! You purchased {product['name']}"
-            })
+            }).decode()
         else:
-            return json.dumps({
+            return orjson.dumps({
                 "success": False,
                 "status": payment_intent.status,
                 "message": "Payment requires additional action"
-            })
+            }).decode()
             
     except stripe.error.CardError as e:
-        print(f"❌ Card Error: {str(e)}")
-        return json.dumps({"error": f"Card error: {str(e)}"})
+        logger.error("Card error: %s", e)
+        return orjson.dumps({"error": f"Card error: {str(e)}"}).decode()
     except stripe.error.StripeError as e:
-        print(f"❌ Stripe Error: {str(e)}")
-        return json.dumps({"error": f"Stripe error: {str(e)}"})
+        logger.error("Stripe error: %s", e)
+        return orjson.dumps({"error": f"Stripe error: {str(e)}"}).decode()
     except Exception as e:
-        print(f"❌ General Error: {str(e)}")
-        import traceback
-        traceback.print_exc()
-        return json.dumps({"error": str(e)})
+        logger.exception("Unexpected error processing payment")
+        return orjson.dumps({"error": str(e)}).decode()
 
-def execute_function(function_name: str, arguments: Dict) -> str:
-    """Execute the requested function"""
+async def execute_function(function_name: str, arguments: Dict, call_id: str) -> str:
+    """Execute the requested function (call_id identifies the model's tool call)"""
     if function_name == "list_products":
         return list_products()
     elif function_name == "create_checkout_session":
-        return create_checkout_session(arguments.get("product_id"))
+        return await create_checkout_session(arguments.get("product_id"), call_id)
     elif function_name == "process_test_payment":
-        return process_test_payment(arguments.get("product_id"))
+        return await process_test_payment(arguments.get("product_id"), call_id)
     else:
-        return json.dumps({"error": "Unknown function"})
+        return orjson.dumps({"error": "Unknown function"}).decode()
+
+# Responses API expects flat function tool definitions
+_RESPONSES_TOOLS = [{"type": "function", **tool["function"]} for tool in tools]
+
+async def respond_via_responses_api(session_id: str, user_message: str) -> str:
+    """Run one turn against server-side state, sending only the new input"""
+    response = await _openai_call(
+        client.responses.create,
+        model="gpt-4o-mini",
+        instructions=SYSTEM_PROMPT,
+        input=user_message,
+        previous_response_id=await load_previous_response_id(session_id),
+        tools=_RESPONSES_TOOLS
+    )
+    
+    function_calls = [item for item in response.output if item.type == "function_call"]
+    if function_calls:
+        for call in function_calls:
+            logger.info("Executing function %s arguments=%s", call.name, call.arguments)
+        results = await asyncio.gather(*[
+            execute_function(call.name, orjson.loads(call.arguments), call.call_id)
+            for call in function_calls
+        ])
+        outputs = [
+            {
+                "type": "function_call_output",
+                "call_id": call.call_id,
+                "output": output
+            }
+            for call, output in zip(function_calls, results)
+        ]
+        
+        # Get final response, chained from the tool-calling response
+        response = await _openai_call(
+            client.responses.create,
+            model="gpt-4o-mini",
+            instructions=SYSTEM_PROMPT,
+            input=outputs,
+            previous_response_id=response.id
+        )
+    
+    await save_previous_response_id(session_id, response.id)
+    return response.output_text
+
+def _tool_call_message(assistant_message: ChatCompletionMessage) -> Dict:
+    """History entry for an assistant message that requests tool calls"""
+    return {
+        "role": "assistant",
+        "content": assistant_message.content,
+        "tool_calls": [tc.model_dump() for tc in assistant_message.tool_calls]
+    }
+
+async def run_tool_calls(history: List[Dict], assistant_message: ChatCompletionMessage):
+    """Execute the assistant's tool calls and append the call and its results to history"""
+    # Add assistant's function call to history
+    history.append(_tool_call_message(assistant_message))
+    
+    # Execute all function calls concurrently (wall-clock is the slowest call, not the sum)
+    for tool_call in assistant_message.tool_calls:
+        logger.info("Executing function %s arguments=%s", tool_call.function.name, tool_call.function.arguments)
+    
+    function_responses = await asyncio.gather(*[
+        execute_function(tool_call.function.name, orjson.loads(tool_call.function.arguments), tool_call.id)
+        for tool_call in assistant_message.tool_calls
+    ])
+    
+    # Results come back in call order
+    for tool_call, function_response in zip(assistant_message.tool_calls, function_responses):
+        logger.info("Function response: %s", function_response)
+        
+        # Add function result to conversation
+        history.append({
+            "role": "tool",
+            "tool_call_id": tool_call.id,
+            "content": function_response
+        })
+
+# Predicted tool outputs, used to start the summary call while the real (Stripe) call is in flight
+_CHECKOUT_URL_PLACEHOLDER = "https://checkout.stripe.com/c/pay/cs_checkout_url_placeholder"
+_CHECKOUT_SESSION_PLACEHOLDER = "cs_checkout_session_placeholder"
+_TOOL_RESPONSE_TEMPLATES = {
+    "create_checkout_session": orjson.dumps({
+        "success": True,
+        "checkout_url": _CHECKOUT_URL_PLACEHOLDER,
+        "session_id": _CHECKOUT_SESSION_PLACEHOLDER
+    }).decode()
+}
+
+def start_summary_prefetch(history: List[Dict], assistant_message: ChatCompletionMessage) -> Optional[asyncio.Task]:
+    """Speculatively start the summary call for a single templated tool call, using its predicted output"""
+    tool_calls = assistant_message.tool_calls
+    if len(tool_calls) != 1 or tool_calls[0].function.name not in _TOOL_RESPONSE_TEMPLATES:
+        return None
+    
+    predicted = history + [
+        _tool_call_message(assistant_message),
+        {
+            "role": "tool",
+            "tool_call_id": tool_calls[0].id,
+            "content": _TOOL_RESPONSE_TEMPLATES[tool_calls[0].function.name]
+        }
+    ]
+    # Default tier: the prefetch only exists to cut latency, so it must not queue behind Flex
+    return asyncio.create_task(cached_completion(predicted, flex=False))
+
+async def finish_summary_prefetch(prefetch: asyncio.Task, function_response: str) -> Optional[Tuple[str, bool]]:
+    """Return (final_message, cache_hit) filled in with the real tool output, or None to fall back"""
+    result = orjson.loads(function_response)
+    if not result.get("success"):
+        prefetch.cancel()
+        return None
+    
+    try:
+        completion, cache_hit = await prefetch
+    except Exception:
+        logger.exception("Summary prefetch failed")
+        return None
+    
+    final_message = completion.choices[0].message.content or ""
+    if _CHECKOUT_URL_PLACEHOLDER not in final_message:
+        return None
+    final_message = final_message.replace(_CHECKOUT_URL_PLACEHOLDER, result["checkout_url"])
+    return final_message.replace(_CHECKOUT_SESSION_PLACEHOLDER, result["session_id"]), cache_hit
 
 @app.route('/chat', methods=['POST'])
-def chat():
+async def chat():
     """Main chat endpoint"""
-    data = request.json
+    data = await request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({"error": "Request body must be a JSON object"}), 400
     user_message = data.get('message', '')
     session_id = data.get('session_id', 'default')
     
-    # Initialize conversation history
-    if session_id not in conversations:
-        conversations[session_id] = [
-            {
-                "role": "system",
-                "content": """You are a helpful sales assistant for a gift card store. 
-                
-Help users browse and purchase gift cards. When they want to buy something:
-1. Use the create_checkout_session function to generate a payment link
-2. The function will return a JSON with "checkout_url"
-3. Share that URL with the user in a friendly way
-
-Important: When you receive the checkout URL, present it to the user like this:
-"Great! I've created your checkout session. Click here to complete your payment: [URL]"
-
-Always be friendly and helpful!"""
-            }
-        ]
+    if USE_RESPONSES_API:
+        try:
+            reply = await respond_via_responses_api(session_id, user_message)
+        except Exception as e:
+            logger.exception("Error in chat endpoint")
+            return jsonify({"error": str(e)}), 500
+        return jsonify({
+            "response": reply,
+            "session_id": session_id
+        })
+    
+    # Load conversation history; messages from index `turn_start` on are new this turn
+    history = await load_history(session_id)
+    turn_start = len(history)
+    
+    # Semantic cache only answers opening questions, where no prior context can change the reply
+    embedding = None
+    if redis_client is not None and len(history) == 1:
+        embedding, cached_reply = await semantic_cache_lookup(user_message)
+        if cached_reply is not None:
+            await append_history(session_id, [
+                {"role": "user", "content": user_message},
+                {"role": "assistant", "content": cached_reply}
+            ])
+            return jsonify({
+                "response": cached_reply,
+                "session_id": session_id
+            }), 200, {"X-Cache": "SEMANTIC_HIT"}
     
     # Add user message
-    conversations[session_id].append({
+    history.append({
         "role": "user",
         "content": user_message
     })
     
     try:
-        # Call OpenAI API with new client
-        response = client.chat.completions.create(
-            model="gpt-4o-mini",  # Updated to use gpt-4o-mini (cheaper and available)
-            messages=conversations[session_id],
-            tools=tools,
-            tool_choice="auto"
-        )
+        # Call OpenAI API (served from the exact-match cache when possible)
+        response, cache_hit = await cached_completion(history, tools=tools)
         
         assistant_message = response.choices[0].message
         
         # Check if function call is needed
         if assistant_message.tool_calls:
-            # Add assistant's function call to history
-            conversations[session_id].append({
-                "role": "assistant",
-                "content": assistant_message.content,
-                "tool_calls": assistant_message.tool_calls
-            })
+            prefetch = start_summary_prefetch(history, assistant_message)
+            try:
+                await run_tool_calls(history, assistant_message)
+            except BaseException:
+                if prefetch is not None:
+                    prefetch.cancel()
+                raise
             
-            # Execute each function call
-            for tool_call in assistant_message.tool_calls:
-                function_name = tool_call.function.name
-                arguments = json.loads(tool_call.function.arguments)
-                
-                print(f"🔧 Executing function: {function_name}")
-                print(f"📝 Arguments: {arguments}")
+            # Use the speculative summary when the real tool output matches its template
+            prefetched = None
+            if prefetch is not None:
+                prefetched = await finish_summary_prefetch(prefetch, history[-1]["content"])
+            
+            if prefetched is not None:
+                final_message, cache_hit = prefetched
+            else:
+                # Get final response from ChatGPT
+                final_response, cache_hit = await cached_completion(history)
                 
-                # Execute function
-                function_response = execute_function(function_name, arguments)
-                print(f"📤 Function response: {function_response}")
+                logger.debug("Final completion: %s", final_response)
                 
-                # Add function result to conversation
-                conversations[session_id].append({
-                    "role": "tool",
-                    "tool_call_id": tool_call.id,
-                    "content": function_response
-                })
-            
-            # Get final response from ChatGPT
-            final_response = client.chat.completions.create(
-                model="gpt-4o-mini",  # Updated to use gpt-4o-mini
-                messages=conversations[session_id]
-            )
-            
-            print(f"Semi Final response: {final_response}")
-
-            final_message = final_response.choices[0].message.content
-            conversations[session_id].append({
+                final_message = final_response.choices[0].message.content
+            history.append({
                 "role": "assistant",
                 "content": final_message
             })
+            await append_history(session_id, history[turn_start:])
+            
+            logger.info("Final response: %s", final_message)
             
-            print(f"💬 Final response: {final_message}")
+            # Cache the reply unless the turn had side effects (payments, checkout sessions);
+            # the write happens after the response is sent
+            intent = assistant_message.tool_calls[0].function.name
+            called = {tc.function.name for tc in assistant_message.tool_calls}
+            if embedding is not None and not called & _SIDE_EFFECT_TOOLS:
+                app.add_background_task(semantic_cache_store, embedding, intent, final_message)
             
             return jsonify({
                 "response": final_message,
                 "session_id": session_id
-            })
+            }), 200, {"X-Cache": "HIT" if cache_hit else "MISS"}
         else:
             # No function call, just return response
-            conversations[session_id].append({
+            history.append({
                 "role": "assistant",
                 "content": assistant_message.content
             })
+            await append_history(session_id, history[turn_start:])
+            
+            if embedding is not None and assistant_message.content:
+                app.add_background_task(semantic_cache_store, embedding, "chat", assistant_message.content)
             
             return jsonify({
                 "response": assistant_message.content,
                 "session_id": session_id
-            })
+            }), 200, {"X-Cache": "HIT" if cache_hit else "MISS"}
             
     except Exception as e:
-        print(f"❌ Error in chat endpoint: {str(e)}")
+        logger.exception("Error in chat endpoint")
         return jsonify({"error": str(e)}), 500
 
+def _sse(payload: Dict) -> bytes:
+    """Encode one Server-Sent Events message"""
+    return b"data: " + orjson.dumps(payload) + b"\n\n"
+
+@app.route('/chat/stream', methods=['POST'])
+async def chat_stream():
+    """Chat endpoint that streams the assistant reply as Server-Sent Events"""
+    data = await request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({"error": "Request body must be a JSON object"}), 400
+    user_message = data.get('message', '')
+    session_id = data.get('session_id', 'default')
+    
+    history = await load_history(session_id)
+    turn_start = len(history)
+    history.append({
+        "role": "user",
+        "content": user_message
+    })
+    
+    try:
+        response, _ = await cached_completion(history, tools=tools)
+        assistant_message = response.choices[0].message
+        if assistant_message.tool_calls:
+            await run_tool_calls(history, assistant_message)
+    except Exception as e:
+        logger.exception("Error in chat stream endpoint")
+        return jsonify({"error": str(e)}), 500
+    
+    async def events():
+        try:
+            if assistant_message.tool_calls:
+                # Stream the final response token by token instead of waiting for all of it
+                stream = await create_summary_completion(
+                    model="gpt-4o-mini",
+                    messages=history,
+                    stream=True
+                )
+                chunks = []
+                async for chunk in stream:
+                    delta = chunk.choices[0].delta.content if chunk.choices else None
+                    if delta:
+                        chunks.append(delta)
+                        yield _sse({"delta": delta})
+                final_message = "".join(chunks)
+            else:
+                final_message = assistant_message.content or ""
+                yield _sse({"delta": final_message})
+            
+            history.append({
+                "role": "assistant",
+                "content": final_message
+            })
+            await append_history(session_id, history[turn_start:])
+            yield _sse({"done": True, "session_id": session_id})
+        except Exception as e:
+            logger.exception("Error in chat stream endpoint")
+            yield _sse({"error": str(e)})
+    
+    return Response(events(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'  # stop nginx from buffering the stream
+    })
+
+# Webhook event types we act on; anything else is acknowledged without being parsed
+HANDLED_WEBHOOK_EVENTS = frozenset({'checkout.session.completed'})
+_HANDLED_WEBHOOK_EVENT_BYTES = tuple(event_type.encode() for event_type in HANDLED_WEBHOOK_EVENTS)
+WEBHOOK_TOLERANCE = 300  # seconds
+
 @app.route('/webhook', methods=['POST'])
-def webhook():
+async def webhook():
     """Handle Stripe webhooks"""
-    payload = request.data
+    payload = await request.get_data()
     sig_header = request.headers.get('Stripe-Signature')
+    if not sig_header:
+        return jsonify({"error": "Missing Stripe-Signature header"}), 400
     
+    # Verify the HMAC only; construct_event would also build a full stripe.Event object
     try:
-        event = stripe.Webhook.construct_event(
-            payload, sig_header, STRIPE_WEBHOOK_SECRET
+        stripe.WebhookSignature.verify_header(
+            payload.decode('utf-8'), sig_header, STRIPE_WEBHOOK_SECRET, tolerance=WEBHOOK_TOLERANCE
         )
     except Exception as e:
         return jsonify({"error": str(e)}), 400
     
+    # Cheap byte scan before parsing: unhandled event types never get decoded
+    if not any(event_type in payload for event_type in _HANDLED_WEBHOOK_EVENT_BYTES):
+        return jsonify({"status": "success"}), 200
+    
+    event = orjson.loads(payload)
+    
     # Handle different event types
     if event['type'] == 'checkout.session.completed':
         session = event['data']['object']
         
         # Fulfill the order (save to database, send email, etc.)
-        print(f"Payment successful! Session ID: {session['id']}")
-        print(f"Product ID: {session['metadata'].get('product_id')}")
+        logger.info(
+            "Payment successful session_id=%s product_id=%s",
+            session['id'], session['metadata'].get('product_id')
+        )
         
         # TODO: Save order to database
         # TODO: Send confirmation email
@@ -385,31 +1049,10 @@ def webhook():
     return jsonify({"status": "success"}), 200
 
 @app.route('/health', methods=['GET'])
-def health():
+async def health():
     """Health check endpoint"""
     return jsonify({"status": "healthy"})
 
 if __name__ == '__main__':
-    # Validate API keys before starting
-    if not os.getenv('OPENAI_API_KEY'):
-        print("❌ ERROR: OPENAI_API_KEY not found in environment variables")
-        exit(1)
-    
-    if not os.getenv('STRIPE_SECRET_KEY'):
-        print("❌ ERROR: STRIPE_SECRET_KEY not found in environment variables")
-        exit(1)
-    
-    print("✅ OpenAI API Key loaded")
-    print("✅ Stripe API Key loaded")
-    print(f"✅ Stripe Key starts with: {stripe.api_key[:12]}...")
-    
-    # Check if in test mode
-    if stripe.api_key.startswith('sk_test_'):
-        print("✅ Stripe is in TEST MODE (safe for development)")
-    elif stripe.api_key.startswith('sk_live_'):
-        print("⚠️  WARNING: Stripe is in LIVE MODE (real charges will be made!)")
-    else:
-        print("❌ ERROR: Invalid Stripe API key format")
-        exit(1)
-    
-    app.run(debug=True, port=5000)
\ No newline at end of file
+    # Development server only; see README for running under hypercorn in production
+    app.run(debug=True, port=5000)